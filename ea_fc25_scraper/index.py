@@ -1,87 +1,517 @@
 import asyncio
 import aiohttp
-import json
+import aiosqlite
+import orjson
 import os
 import argparse
+import contextlib
+import functools
+import math
 import gzip
-from typing import Dict, List, Any
+import random
+import sys
+import time
+import zstandard as zstd
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import (
+    Dict, List, Any, Optional, Callable, Awaitable, BinaryIO, Sequence, Union, NamedTuple, Set, Iterator, Tuple
+)
 
 BASE_URL = "https://drop-api.ea.com/rating/ea-sports-fc"
 CACHE_DIR = "cache"
+CACHE_DB_FILE = "pages.db"
+CACHE_BATCH_SIZE = 32
 OUTPUT_FILE = "players_data.json"
-COMPRESSED_OUTPUT_FILE = "players_data.json.gz"
-
-async def fetch_page(session: aiohttp.ClientSession, offset: int) -> Dict[str, Any]:
-    params = {
-        "locale": "en",
-        "limit": 100,
-        "offset": offset
-    }
-    async with session.get(BASE_URL, params=params) as response:
-        response.raise_for_status()
-        return await response.json()
-
-async def fetch_all_pages(skip_cache: bool) -> List[Dict[str, Any]]:
+COMPRESSED_OUTPUT_FILE = "players_data.json.zst"
+PARQUET_OUTPUT_FILE = "players_data.parquet"
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COPY_CHUNK_SIZE = 64 * 1024
+PAGE_SIZE = 100
+PAGE_URL_TEMPLATE = f"{BASE_URL}?locale=en&limit={PAGE_SIZE}&offset={{}}"
+PROBE_BATCH_SIZE = 20
+MAX_CONCURRENCY = 20
+REQUESTS_PER_SECOND = 10.0
+REQUESTS_PER_SECOND_ENV = "EA_FC_REQUESTS_PER_SECOND"
+REQUEST_TIMEOUT = 30
+RETRY_ATTEMPTS = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_BACKOFF = 30
+
+class RateLimiter:
+    """Token bucket that lets through at most `requests_per_second` requests on average."""
+
+    def __init__(self, requests_per_second: float, burst: Optional[int] = None):
+        if not requests_per_second > 0:
+            raise ValueError(f"requests_per_second must be positive, got {requests_per_second}")
+        self.rate = requests_per_second
+        self.capacity = burst if burst is not None else max(1, int(requests_per_second))
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def requests_per_second_from_env() -> float:
+    value = os.environ.get(REQUESTS_PER_SECOND_ENV)
+    if value is None:
+        return REQUESTS_PER_SECOND
+    try:
+        requests_per_second = float(value)
+    except ValueError:
+        requests_per_second = math.nan
+    if not 0 < requests_per_second < math.inf:
+        raise ValueError(f"{REQUESTS_PER_SECOND_ENV} must be a positive number, got {value!r}")
+    return requests_per_second
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class RawPage(NamedTuple):
+    body: Optional[bytes]  # None when the server answered 304 Not Modified
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+class PageCache:
+    """SQLite store of zstd-compressed API pages keyed by offset, written in transactions of CACHE_BATCH_SIZE."""
+
+    def __init__(self, directory: str, fresh: bool = False):
+        self.directory = directory
+        self.fresh = fresh
+        self.db: Optional[aiosqlite.Connection] = None
+        self.pending_pages: Dict[int, Tuple[int, RawPage]] = {}
+        self.pending_touches: Dict[int, int] = {}
+        self.pending_deletes: Set[int] = set()
+        self.offsets: Set[int] = set()
+        self.compressor = zstd.ZstdCompressor(level=1)
+        self.decompressor = zstd.ZstdDecompressor()
+
+    async def __aenter__(self) -> "PageCache":
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = await aiosqlite.connect(os.path.join(self.directory, CACHE_DB_FILE))
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "offset INTEGER PRIMARY KEY, fetched_at INTEGER NOT NULL, body BLOB NOT NULL, "
+            "etag TEXT, last_modified TEXT)"
+        )
+        # Caches created before conditional requests lack the validator columns.
+        async with self.db.execute("PRAGMA table_info(pages)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                await self.db.execute(f"ALTER TABLE pages ADD COLUMN {column} TEXT")
+        await self.db.commit()
+        await self.import_legacy_pages()
+
+        # Learn every cached offset in one query so misses never have to touch the database.
+        if not self.fresh:
+            async with self.db.execute("SELECT offset FROM pages") as cursor:
+                self.offsets = {row[0] for row in await cursor.fetchall()}
+        return self
+
+    async def import_legacy_pages(self):
+        """Move pages cached as page_{offset}.json files by older versions into the database."""
+        legacy_files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                offset = entry.name.removeprefix("page_").removesuffix(".json")
+                if entry.name == f"page_{offset}.json" and offset.isdigit():
+                    legacy_files[int(offset)] = entry.path
+        if not legacy_files:
+            return
+
+        rows = []
+        for offset, path in legacy_files.items():
+            with open(path, "rb") as f:
+                body = f.read()
+            try:
+                orjson.loads(body)
+            except orjson.JSONDecodeError:
+                continue
+            rows.append((offset, int(os.path.getmtime(path)), self.compressor.compress(body)))
+
+        # Rows already in the database are newer than any leftover file, so keep them.
+        await self.db.executemany(
+            "INSERT OR IGNORE INTO pages (offset, fetched_at, body) VALUES (?, ?, ?)", rows
+        )
+        await self.db.commit()
+        for path in legacy_files.values():
+            os.remove(path)
+
+    async def __aexit__(self, *exc_info):
+        await self.flush()
+        await self.db.close()
+
+    async def get(self, offset: int) -> Optional[RawPage]:
+        if offset not in self.offsets:
+            return None
+        if offset in self.pending_pages:
+            return self.pending_pages[offset][1]
+        async with self.db.execute(
+            "SELECT body, etag, last_modified FROM pages WHERE offset = ?", (offset,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+
+        # Rows written before cache compression hold plain JSON.
+        body, etag, last_modified = row
+        if body.startswith(ZSTD_MAGIC):
+            body = self.decompressor.decompress(body)
+        return RawPage(body, etag, last_modified)
+
+    async def put(self, offset: int, page: RawPage):
+        self.pending_pages[offset] = (int(time.time()), page)
+        self.pending_touches.pop(offset, None)
+        self.pending_deletes.discard(offset)
+        self.offsets.add(offset)
+        await self.flush_if_full()
+
+    async def delete(self, offset: int):
+        self.offsets.discard(offset)
+        self.pending_pages.pop(offset, None)
+        self.pending_touches.pop(offset, None)
+        self.pending_deletes.add(offset)
+        await self.flush_if_full()
+
+    async def touch(self, offset: int):
+        self.pending_touches[offset] = int(time.time())
+        await self.flush_if_full()
+
+    async def flush_if_full(self):
+        if len(self.pending_pages) + len(self.pending_touches) + len(self.pending_deletes) >= CACHE_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        # Take the pending writes first so puts made while this batch is being written land in the next one.
+        pages, self.pending_pages = self.pending_pages, {}
+        touches, self.pending_touches = self.pending_touches, {}
+        deletes, self.pending_deletes = self.pending_deletes, set()
+        if not pages and not touches and not deletes:
+            return
+
+        await self.db.executemany("DELETE FROM pages WHERE offset = ?", [(offset,) for offset in deletes])
+
+        await self.db.executemany(
+            "INSERT OR REPLACE INTO pages (offset, fetched_at, body, etag, last_modified) VALUES (?, ?, ?, ?, ?)",
+            [
+                (offset, fetched_at, self.compressor.compress(page.body), page.etag, page.last_modified)
+                for offset, (fetched_at, page) in pages.items()
+            ]
+        )
+        await self.db.executemany(
+            "UPDATE pages SET fetched_at = ? WHERE offset = ?",
+            [(fetched_at, offset) for offset, fetched_at in touches.items()]
+        )
+        await self.db.commit()
+
+async def fetch_raw_page(
+    session: aiohttp.ClientSession,
+    offset: int,
+    limiter: Optional[RateLimiter] = None,
+    cached: Optional[RawPage] = None
+) -> RawPage:
+    url = PAGE_URL_TEMPLATE.format(offset)
+    # Let the server answer 304 Not Modified when the cached copy is still current.
+    headers = {}
+    if cached is not None and cached.etag is not None:
+        headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified is not None:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    for attempt in range(RETRY_ATTEMPTS):
+        if limiter is not None:
+            await limiter.acquire()
+        retry_after = None
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status in RETRY_STATUSES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                response.raise_for_status()
+                if response.status == 304:
+                    if cached is None:
+                        # We sent no validators, so there is nothing for this to refer to.
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                            message="Not Modified without a cached copy",
+                            headers=response.headers
+                        )
+                    return RawPage(None, cached.etag, cached.last_modified)
+                return RawPage(
+                    await response.read(), response.headers.get("ETag"), response.headers.get("Last-Modified")
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+
+        # Honour the server's Retry-After, otherwise back off exponentially with jitter.
+        if retry_after is None:
+            retry_after = 2 ** attempt + random.random()
+        await asyncio.sleep(min(MAX_BACKOFF, retry_after))
+
+async def fetch_page(
+    session: aiohttp.ClientSession, offset: int, limiter: Optional[RateLimiter] = None
+) -> Dict[str, Any]:
+    return orjson.loads((await fetch_raw_page(session, offset, limiter)).body)
+
+async def load_page(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    limiter: RateLimiter,
+    cache: PageCache,
+    refresh: bool,
+    offset: int
+) -> Dict[str, Any]:
+    cached = await cache.get(offset)
+    if cached is not None:
+        try:
+            cached_data = orjson.loads(cached.body)
+        except orjson.JSONDecodeError:
+            # A page that doesn't parse is useless, so forget it and fetch it again.
+            await cache.delete(offset)
+            cached = None
+    if cached is not None and not refresh:
+        return cached_data
+
+    async with sem:
+        try:
+            page = await fetch_raw_page(session, offset, limiter, cached)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if cached is None:
+                raise
+            # A failed revalidation shouldn't cost us a page we already have.
+            print(f"Error refreshing page at offset {offset}, using cached copy: {e}")
+            return cached_data
+    if page.body is None:
+        await cache.touch(offset)
+        return cached_data
+
+    # Parse before caching so an error page served with a 200 never ends up in the cache.
+    page_data = orjson.loads(page.body)
+    await cache.put(offset, page)
+    return page_data
+
+async def load_pages(
+    load: Callable[[int], Awaitable[Dict[str, Any]]], offsets: Sequence[int]
+) -> List[Union[Dict[str, Any], Exception]]:
+    """Load `offsets` concurrently.
+
+    Results come back in the order of `offsets`; a page that failed to load or parse is returned as its exception.
+    """
+    async def load_or_error(offset: int) -> Union[Dict[str, Any], Exception]:
+        try:
+            return await load(offset)
+        except Exception as e:
+            return e
+
+    return await asyncio.gather(*(load_or_error(offset) for offset in offsets))
+
+async def crawl_pages(load: Callable[[int], Awaitable[Dict[str, Any]]]) -> List[Dict[str, Any]]:
     all_data = []
-    offset = 0
-    
-    async with aiohttp.ClientSession() as session:
-        while True:
-            cache_file = os.path.join(CACHE_DIR, f"page_{offset}.json")
-            
-            if not skip_cache and os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    page_data = json.load(f)
-            else:
-                try:
-                    page_data = await fetch_page(session, offset)
-                    os.makedirs(CACHE_DIR, exist_ok=True)
-                    with open(cache_file, "w") as f:
-                        json.dump(page_data, f)
-                except aiohttp.ClientError as e:
-                    print(f"Error fetching page at offset {offset}: {e}")
-                    break
+
+    (first_page,) = await load_pages(load, [0])
+    if isinstance(first_page, Exception):
+        print(f"Error fetching page at offset 0: {first_page}")
+        return all_data
+
+    all_data.extend(first_page["items"])
+    if len(first_page["items"]) < PAGE_SIZE:
+        return all_data
+
+    total = first_page.get("totalItems")
+    if total is not None:
+        # The total is known up front, so every remaining page can be requested at once.
+        offsets = range(PAGE_SIZE, total, PAGE_SIZE)
+        pages = await load_pages(load, offsets)
+
+        # Size the result once and drop each page into its slot instead of growing the list page by page.
+        all_data += [None] * (total - len(all_data))
+        complete = True
+        for offset, page_data in zip(offsets, pages):
+            if isinstance(page_data, Exception):
+                print(f"Error fetching page at offset {offset}: {page_data}")
+                complete = False
+                continue
+            items = page_data["items"]
+            all_data[offset:offset + len(items)] = items
+            complete = complete and len(items) == min(PAGE_SIZE, total - offset)
+
+        # Failed or short pages leave empty slots behind.
+        if not complete:
+            all_data = [item for item in all_data if item is not None]
+        return all_data
+
+    # Without a total, probe PROBE_BATCH_SIZE pages at a time until a short page shows up.
+    start = PAGE_SIZE
+    while True:
+        offsets = range(start, start + PROBE_BATCH_SIZE * PAGE_SIZE, PAGE_SIZE)
+        pages = await load_pages(load, offsets)
+        for offset, page_data in zip(offsets, pages):
+            if isinstance(page_data, Exception):
+                print(f"Error fetching page at offset {offset}: {page_data}")
+                return all_data
 
             all_data.extend(page_data["items"])
-            
-            if len(page_data["items"]) < 100:
-                break
-            
-            offset += 100
-    
-    return all_data
+            if len(page_data["items"]) < PAGE_SIZE:
+                return all_data
+
+        start += PROBE_BATCH_SIZE * PAGE_SIZE
+
+async def fetch_all_pages(skip_cache: bool, refresh: bool = False) -> List[Dict[str, Any]]:
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = RateLimiter(requests_per_second_from_env())
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=MAX_CONCURRENCY,
+        ttl_dns_cache=300,
+        keepalive_timeout=30
+    )
+
+    async with PageCache(CACHE_DIR, fresh=skip_cache) as cache, aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    ) as session:
+        return await crawl_pages(functools.partial(load_page, session, sem, limiter, cache, refresh))
+
+@contextlib.contextmanager
+def atomic_open(filename: str) -> Iterator[BinaryIO]:
+    """Open `filename` for binary writing through a temp file that only replaces it once fully written."""
+    tmp_filename = f"{filename}.tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        raise
 
 def save_json(data: List[Dict[str, Any]], filename: str):
-    with open(filename, "w") as f:
-        json.dump(data, f, indent=2)
+    with atomic_open(filename) as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def to_columns(rows: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """Turn a list of records into one list per field, filling in None where a record lacks the field."""
+    keys = dict.fromkeys(key for row in rows for key in row)
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet output needs pyarrow, install it with `poetry install -E parquet`") from e
+    return pa, pq
+
+def save_parquet(data: List[Dict[str, Any]], filename: str):
+    pa, pq = import_pyarrow()
+    with atomic_open(filename) as f:
+        pq.write_table(pa.table(to_columns(data)), f, compression="zstd")
+
+def copy_chunks(f_in: BinaryIO, f_out: BinaryIO):
+    # Read into one reused buffer rather than allocating a bytes object per line.
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+    while n := f_in.readinto(buf):
+        f_out.write(view[:n])
+
+def save_compressed(data: List[Dict[str, Any]], filename: str, plain_filename: Optional[str] = None):
+    # Serialize once and feed the same bytes to the compressor and, if requested, the plain file.
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    with atomic_open(filename) as f:
+        with zstd.ZstdCompressor(level=3, threads=-1).stream_writer(f, closefd=False) as writer:
+            writer.write(payload)
+    if plain_filename is not None:
+        with atomic_open(plain_filename) as f:
+            f.write(payload)
 
 def compress_json(input_file: str, output_file: str):
-    with open(input_file, "rb") as f_in:
-        with gzip.open(output_file, "wb") as f_out:
-            f_out.writelines(f_in)
+    cctx = zstd.ZstdCompressor(level=3, threads=-1)
+    with open(input_file, "rb") as f_in, atomic_open(output_file) as f_out:
+        cctx.copy_stream(f_in, f_out)
 
 def decompress_json(input_file: str, output_file: str):
-    with gzip.open(input_file, "rb") as f_in:
-        with open(output_file, "wb") as f_out:
-            f_out.writelines(f_in)
+    with open(input_file, "rb") as f:
+        magic = f.read(len(GZIP_MAGIC))
+
+    # Dumps from before the switch to zstd are gzip, so keep reading those.
+    if magic == GZIP_MAGIC:
+        with gzip.open(input_file, "rb") as f_in:
+            with atomic_open(output_file) as f_out:
+                copy_chunks(f_in, f_out)
+        return
+
+    with open(input_file, "rb") as f_in, atomic_open(output_file) as f_out:
+        zstd.ZstdDecompressor().copy_stream(f_in, f_out)
+
+async def main(skip_cache: bool, parquet: bool = False, refresh: bool = False):
+    # Fail before crawling rather than after, when the Parquet output can't be written anyway.
+    if parquet:
+        import_pyarrow()
 
-async def main(skip_cache: bool):
     print("Fetching player data...")
-    all_data = await fetch_all_pages(skip_cache)
+    all_data = await fetch_all_pages(skip_cache, refresh)
     
     print(f"Total players fetched: {len(all_data)}")
     
-    print(f"Saving data to {OUTPUT_FILE}...")
-    save_json(all_data, OUTPUT_FILE)
-    
-    print(f"Compressing data to {COMPRESSED_OUTPUT_FILE}...")
-    compress_json(OUTPUT_FILE, COMPRESSED_OUTPUT_FILE)
+    print(f"Saving data to {COMPRESSED_OUTPUT_FILE} and {OUTPUT_FILE}...")
+    save_compressed(all_data, COMPRESSED_OUTPUT_FILE, OUTPUT_FILE)
+
+    if parquet:
+        print(f"Saving columnar data to {PARQUET_OUTPUT_FILE}...")
+        save_parquet(all_data, PARQUET_OUTPUT_FILE)
     
     print("Done!")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="EA Sports FC Player Data Crawler")
     parser.add_argument("--skip-cache", action="store_true", help="Skip using cached data")
+    parser.add_argument("--parquet", action="store_true", help="Also write the data as a Parquet file")
+    parser.add_argument(
+        "--refresh", action="store_true", help="Revalidate cached pages with conditional requests instead of reusing them"
+    )
     args = parser.parse_args()
+    try:
+        requests_per_second_from_env()
+        if args.parquet:
+            import_pyarrow()
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
 
-    asyncio.run(main(skip_cache=args.skip_cache if args.skip_cache else False))
\ No newline at end of file
+    coro = main(skip_cache=args.skip_cache if args.skip_cache else False, parquet=args.parquet, refresh=args.refresh)
+    if sys.platform != "win32":
+        import uvloop
+        uvloop.run(coro)
+    else:
+        asyncio.run(coro)
\ No newline at end of file
@@ -1,16 +1,21 @@
+import asyncio
 import types
 
 import aiohttp
 import pytest
 import json
 import os
+import sqlite3
 import gzip
+import zstandard as zstd
 from aioresponses import aioresponses
+from yarl import URL
 from unittest.mock import patch
 
 from ea_fc25_scraper.index import (
-    fetch_page, fetch_all_pages, save_json, compress_json, decompress_json, main,
-    BASE_URL, OUTPUT_FILE, COMPRESSED_OUTPUT_FILE
+    PageCache, RateLimiter, RawPage, fetch_page, fetch_all_pages, load_pages, requests_per_second_from_env,
+    save_json, save_compressed, save_parquet, to_columns, compress_json, decompress_json, main,
+    BASE_URL, PAGE_URL_TEMPLATE, OUTPUT_FILE, COMPRESSED_OUTPUT_FILE, RETRY_ATTEMPTS
 )
 
 @pytest.fixture
@@ -32,6 +37,9 @@ async def test_fetch_page(mock_json_response):
         
         assert result == mock_json_response
 
+def test_page_url_template_matches_query_params():
+    assert PAGE_URL_TEMPLATE.format(300) == str(URL(BASE_URL).with_query(locale="en", limit=100, offset=300))
+
 @pytest.mark.asyncio
 async def test_fetch_page_error():
     with aioresponses() as m:
@@ -41,6 +49,32 @@ async def test_fetch_page_error():
             async with aiohttp.ClientSession() as session:
                 await fetch_page(session, 0)
 
+@pytest.mark.asyncio
+async def test_fetch_page_retries_transient_errors(mock_json_response):
+    with aioresponses() as m, patch("ea_fc25_scraper.index.asyncio.sleep") as mock_sleep:
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=503)
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=429, headers={"Retry-After": "7"})
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", payload=mock_json_response)
+
+        async with aiohttp.ClientSession() as session:
+            result = await fetch_page(session, 0)
+
+    assert result == mock_json_response
+    assert mock_sleep.call_count == 2
+    assert 1 <= mock_sleep.call_args_list[0].args[0] < 2
+    assert mock_sleep.call_args_list[1].args[0] == 7
+
+@pytest.mark.asyncio
+async def test_fetch_page_gives_up_after_retries():
+    with aioresponses() as m, patch("ea_fc25_scraper.index.asyncio.sleep") as mock_sleep:
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=500, repeat=True)
+
+        with pytest.raises(aiohttp.ClientResponseError):
+            async with aiohttp.ClientSession() as session:
+                await fetch_page(session, 0)
+
+    assert mock_sleep.call_count == RETRY_ATTEMPTS - 1
+
 @pytest.mark.asyncio
 async def test_fetch_all_pages_no_cache(mock_json_response, tmp_path):
     with aioresponses() as m:
@@ -53,12 +87,12 @@ async def test_fetch_all_pages_no_cache(mock_json_response, tmp_path):
     assert results == mock_json_response["items"]
     
     # Check that the cache file was created
-    cache_file = os.path.join(str(tmp_path), "page_0.json")
+    cache_file = os.path.join(str(tmp_path), "pages.db")
     assert os.path.exists(cache_file)
     
     # Verify cache file contents
-    with open(cache_file, 'r') as f:
-        cached_data = json.load(f)
+    async with PageCache(str(tmp_path)) as cache:
+        cached_data = json.loads((await cache.get(0)).body)
     assert cached_data == mock_json_response
 
 @pytest.mark.asyncio
@@ -68,8 +102,8 @@ async def test_fetch_all_pages_with_cache(tmp_path):
             {"id": 3, "name": "Cached Player"}
         ]
     }
-    cache_file = tmp_path / "page_0.json"
-    cache_file.write_text(json.dumps(cache_data))
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(json.dumps(cache_data).encode()))
 
     with patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
         results = await fetch_all_pages(skip_cache=False)
@@ -77,7 +111,191 @@ async def test_fetch_all_pages_with_cache(tmp_path):
     assert results == cache_data["items"]
 
 @pytest.mark.asyncio
-async def test_fetch_all_pages_multiple_pages():
+async def test_page_cache_roundtrip(tmp_path):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(b'{"items":[{"id":1}]}', etag='"v1"'))
+        await cache.put(100, RawPage(b'{"items":[{"id":2}]}'))
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert await cache.get(0) == RawPage(b'{"items":[{"id":1}]}', etag='"v1"')
+        assert await cache.get(100) == RawPage(b'{"items":[{"id":2}]}')
+        assert await cache.get(200) is None
+        await cache.put(100, RawPage(b'{"items":[]}'))
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert (await cache.get(100)).body == b'{"items":[]}'
+
+    async with PageCache(str(tmp_path), fresh=True) as cache:
+        assert await cache.get(0) is None
+
+@pytest.mark.asyncio
+async def test_page_cache_imports_legacy_page_files(tmp_path):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(200, RawPage(b'{"items":[{"id":2}]}'))
+
+    (tmp_path / "page_0.json").write_text(json.dumps({"items": [{"id": 1}]}))
+    (tmp_path / "page_100.json").write_text("<html>maintenance</html>")
+    (tmp_path / "page_200.json").write_text(json.dumps({"items": [{"id": 3}]}))
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert json.loads((await cache.get(0)).body) == {"items": [{"id": 1}]}
+        assert await cache.get(100) is None
+        assert (await cache.get(200)).body == b'{"items":[{"id":2}]}'
+
+    assert not list(tmp_path.glob("page_*.json"))
+
+@pytest.mark.asyncio
+async def test_page_cache_misses_skip_the_database(tmp_path):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(b'{"items":[]}'))
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert cache.offsets == {0}
+        with patch.object(cache.db, "execute") as mock_execute:
+            assert await cache.get(100) is None
+        mock_execute.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_page_cache_writes_in_batches(tmp_path):
+    def stored_offsets():
+        db = sqlite3.connect(tmp_path / "pages.db")
+        offsets = [row[0] for row in db.execute("SELECT offset FROM pages ORDER BY offset")]
+        db.close()
+        return offsets
+
+    with patch("ea_fc25_scraper.index.CACHE_BATCH_SIZE", 3):
+        async with PageCache(str(tmp_path)) as cache:
+            await cache.put(0, RawPage(b"{}"))
+            await cache.put(100, RawPage(b"{}"))
+            assert stored_offsets() == []
+            assert await cache.get(100) == RawPage(b"{}")
+
+            await cache.put(200, RawPage(b"{}"))
+            assert stored_offsets() == [0, 100, 200]
+
+            await cache.put(300, RawPage(b"{}"))
+            assert stored_offsets() == [0, 100, 200]
+
+    assert stored_offsets() == [0, 100, 200, 300]
+
+@pytest.mark.asyncio
+async def test_page_cache_stores_compressed_bodies(tmp_path):
+    page = json.dumps({"items": [{"id": i, "name": "Player"} for i in range(100)]}).encode()
+
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(page))
+        # Simulate a row written by an older version without compression.
+        await cache.db.execute("INSERT INTO pages (offset, fetched_at, body) VALUES (?, ?, ?)", (100, 0, page))
+
+    db = sqlite3.connect(tmp_path / "pages.db")
+    (body,) = db.execute("SELECT body FROM pages WHERE offset = 0").fetchone()
+    db.close()
+    assert body.startswith(b"\x28\xb5\x2f\xfd")
+    assert len(body) < len(page)
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert (await cache.get(0)).body == page
+        assert (await cache.get(100)).body == page
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_refresh_uses_conditional_requests(tmp_path):
+    url = f"{BASE_URL}?locale=en&limit=100&offset=0"
+    cached_page = {"items": [{"id": 3, "name": "Cached Player"}]}
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(json.dumps(cached_page).encode(), '"v1"', "Tue, 01 Oct 2024 00:00:00 GMT"))
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(url, status=304)
+        results = await fetch_all_pages(skip_cache=False, refresh=True)
+
+        (request,) = next(iter(m.requests.values()))
+        assert request.kwargs["headers"]["If-None-Match"] == '"v1"'
+        assert request.kwargs["headers"]["If-Modified-Since"] == "Tue, 01 Oct 2024 00:00:00 GMT"
+    assert results == cached_page["items"]
+
+    updated_page = {"items": [{"id": 4, "name": "Updated Player"}]}
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(url, payload=updated_page, headers={"ETag": '"v2"'})
+        results = await fetch_all_pages(skip_cache=False, refresh=True)
+    assert results == updated_page["items"]
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert (await cache.get(0)).etag == '"v2"'
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_refresh_keeps_cached_page_on_error(tmp_path, mock_json_response):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(json.dumps(mock_json_response).encode(), '"v1"'))
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)), \
+            patch("ea_fc25_scraper.index.asyncio.sleep"):
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=503, repeat=True)
+        results = await fetch_all_pages(skip_cache=False, refresh=True)
+
+    assert results == mock_json_response["items"]
+
+@pytest.mark.asyncio
+async def test_fetch_page_rejects_unsolicited_not_modified():
+    with aioresponses() as m:
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=304)
+
+        with pytest.raises(aiohttp.ClientResponseError):
+            async with aiohttp.ClientSession() as session:
+                await fetch_page(session, 0)
+
+@pytest.mark.asyncio
+async def test_page_cache_adds_validator_columns_to_old_caches(tmp_path):
+    db = sqlite3.connect(tmp_path / "pages.db")
+    db.execute("CREATE TABLE pages (offset INTEGER PRIMARY KEY, fetched_at INTEGER NOT NULL, body BLOB NOT NULL)")
+    db.execute("INSERT INTO pages VALUES (0, 0, ?)", (b'{"items":[]}',))
+    db.commit()
+    db.close()
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert await cache.get(0) == RawPage(b'{"items":[]}')
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_does_not_cache_unparseable_bodies(tmp_path, mock_json_response):
+    url = f"{BASE_URL}?locale=en&limit=100&offset=0"
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(url, body="<html>maintenance</html>")
+        assert await fetch_all_pages(skip_cache=False) == []
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(url, payload=mock_json_response)
+        assert await fetch_all_pages(skip_cache=False) == mock_json_response["items"]
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert json.loads((await cache.get(0)).body) == mock_json_response
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_refetches_unparseable_cache_rows(tmp_path, mock_json_response):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(b"<html>maintenance</html>"))
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", payload=mock_json_response)
+        results = await fetch_all_pages(skip_cache=False)
+
+    assert results == mock_json_response["items"]
+    async with PageCache(str(tmp_path)) as cache:
+        assert json.loads((await cache.get(0)).body) == mock_json_response
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_forgets_unparseable_cache_rows_when_refetch_fails(tmp_path):
+    async with PageCache(str(tmp_path)) as cache:
+        await cache.put(0, RawPage(b"<html>maintenance</html>"))
+
+    with aioresponses() as m, patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0", status=404)
+        assert await fetch_all_pages(skip_cache=False) == []
+
+    async with PageCache(str(tmp_path)) as cache:
+        assert await cache.get(0) is None
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_multiple_pages(tmp_path):
     responses = [
         {"items": [{"id": i} for i in range(100)]},
         {"items": [{"id": i} for i in range(100, 150)]},
@@ -88,10 +306,126 @@ async def test_fetch_all_pages_multiple_pages():
         for i, resp in enumerate(responses):
             m.get(f"{BASE_URL}?locale=en&limit=100&offset={i*100}", payload=resp)
         
-        results = await fetch_all_pages(skip_cache=True)
+        with patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)), \
+             patch("ea_fc25_scraper.index.PROBE_BATCH_SIZE", 2):
+            results = await fetch_all_pages(skip_cache=True)
 
     assert len(results) == 150
 
+@pytest.mark.asyncio
+async def test_fetch_all_pages_with_total_items(tmp_path):
+    responses = [
+        {"items": [{"id": i} for i in range(100)], "totalItems": 250},
+        {"items": [{"id": i} for i in range(100, 200)], "totalItems": 250},
+        {"items": [{"id": i} for i in range(200, 250)], "totalItems": 250}
+    ]
+
+    with aioresponses() as m:
+        for i, resp in enumerate(responses):
+            m.get(f"{BASE_URL}?locale=en&limit=100&offset={i*100}", payload=resp)
+
+        with patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+            results = await fetch_all_pages(skip_cache=True)
+
+    assert [item["id"] for item in results] == list(range(250))
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_with_total_items_skips_failed_pages(tmp_path):
+    with aioresponses() as m:
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=0",
+              payload={"items": [{"id": i} for i in range(100)], "totalItems": 300})
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=100", status=404)
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=200",
+              payload={"items": [{"id": i} for i in range(200, 250)], "totalItems": 300})
+
+        with patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)):
+            results = await fetch_all_pages(skip_cache=True)
+
+    assert [item["id"] for item in results] == list(range(100)) + list(range(200, 250))
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_probes_in_batches(tmp_path):
+    with aioresponses() as m:
+        for offset in range(0, 500, 100):
+            m.get(f"{BASE_URL}?locale=en&limit=100&offset={offset}",
+                  payload={"items": [{"id": offset + i} for i in range(100)]})
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=500", payload={"items": [{"id": 500}]})
+        m.get(f"{BASE_URL}?locale=en&limit=100&offset=600", payload={"items": []})
+
+        with patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)), \
+             patch("ea_fc25_scraper.index.PROBE_BATCH_SIZE", 2):
+            results = await fetch_all_pages(skip_cache=True)
+
+    assert [item["id"] for item in results] == list(range(501))
+
+@pytest.mark.asyncio
+async def test_fetch_all_pages_bounds_concurrency(tmp_path):
+    in_flight = 0
+    peak = 0
+
+    async def fake_fetch_raw_page(session, offset, limiter=None, cached=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return RawPage(json.dumps({"items": [{"id": offset}] * 100, "totalItems": 1000}).encode())
+
+    with patch("ea_fc25_scraper.index.fetch_raw_page", fake_fetch_raw_page), \
+         patch("ea_fc25_scraper.index.CACHE_DIR", str(tmp_path)), \
+         patch("ea_fc25_scraper.index.MAX_CONCURRENCY", 3):
+        results = await fetch_all_pages(skip_cache=True)
+
+    assert len(results) == 1000
+    assert peak == 3
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(requests_per_second=50, burst=1)
+
+    start = asyncio.get_running_loop().time()
+    for _ in range(6):
+        await limiter.acquire()
+    elapsed = asyncio.get_running_loop().time() - start
+
+    # The first token is free, the remaining five have to wait 20ms each.
+    assert elapsed >= 0.09
+
+@pytest.mark.asyncio
+async def test_load_pages_keeps_order_and_errors():
+    async def load(offset):
+        await asyncio.sleep((500 - offset) / 10000)
+        if offset == 200:
+            raise aiohttp.ClientConnectionError("boom")
+        if offset == 300:
+            raise ValueError("not json")
+        return {"items": [{"id": offset}]}
+
+    pages = await load_pages(load, range(0, 500, 100))
+
+    assert pages[0] == {"items": [{"id": 0}]}
+    assert pages[1] == {"items": [{"id": 100}]}
+    assert isinstance(pages[2], aiohttp.ClientConnectionError)
+    assert isinstance(pages[3], ValueError)
+    assert pages[4] == {"items": [{"id": 400}]}
+
+@pytest.mark.parametrize("value", ["fast", "0", "-5", "nan", "inf"])
+def test_requests_per_second_from_env_rejects_invalid_values(value):
+    with patch.dict(os.environ, {"EA_FC_REQUESTS_PER_SECOND": value}):
+        with pytest.raises(ValueError, match="EA_FC_REQUESTS_PER_SECOND must be a positive number"):
+            requests_per_second_from_env()
+
+def test_requests_per_second_from_env():
+    with patch.dict(os.environ, {"EA_FC_REQUESTS_PER_SECOND": "2.5"}):
+        assert requests_per_second_from_env() == 2.5
+    with patch.dict(os.environ):
+        os.environ.pop("EA_FC_REQUESTS_PER_SECOND", None)
+        assert requests_per_second_from_env() == 10
+
+def test_rate_limiter_rejects_non_positive_rates():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
 def test_save_json(tmp_path):
     data = [{"id": 1, "name": "Test Player"}]
     filename = tmp_path / "test_output.json"
@@ -103,10 +437,63 @@ def test_save_json(tmp_path):
         saved_data = json.load(f)
     assert saved_data == data
 
+def test_save_compressed(tmp_path):
+    data = [{"id": 1, "name": "Test Player"}]
+    compressed_file = tmp_path / "output.json.zst"
+    plain_file = tmp_path / "output.json"
+
+    save_compressed(data, str(compressed_file), str(plain_file))
+
+    with open(compressed_file, "rb") as f:
+        decompressed = zstd.ZstdDecompressor().stream_reader(f).read()
+    assert json.loads(decompressed) == data
+    assert plain_file.read_bytes() == decompressed
+
+def test_save_compressed_without_plain_copy(tmp_path):
+    save_compressed([{"id": 1}], str(tmp_path / "output.json.zst"))
+
+    assert [p.name for p in tmp_path.iterdir()] == ["output.json.zst"]
+
+def test_to_columns_aligns_missing_fields():
+    rows = [
+        {"id": 1, "name": "A"},
+        {"id": 2, "rating": 90},
+        {"id": 3, "name": "C", "rating": 80}
+    ]
+
+    assert to_columns(rows) == {
+        "id": [1, 2, 3],
+        "name": ["A", None, "C"],
+        "rating": [None, 90, 80]
+    }
+
+def test_save_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    data = [{"id": 1, "name": "Test Player", "nationality": {"id": 7, "label": "France"}}, {"id": 2}]
+    filename = tmp_path / "output.parquet"
+
+    save_parquet(data, str(filename))
+
+    assert pq.read_table(filename).to_pylist() == [
+        {"id": 1, "name": "Test Player", "nationality": {"id": 7, "label": "France"}},
+        {"id": 2, "name": None, "nationality": None}
+    ]
+
+def test_save_compressed_keeps_previous_output_on_failure(tmp_path):
+    filename = tmp_path / "output.json.zst"
+    filename.write_bytes(b"previous run")
+
+    with patch("ea_fc25_scraper.index.zstd.ZstdCompressor.stream_writer", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            save_compressed([{"id": 1}], str(filename))
+
+    assert filename.read_bytes() == b"previous run"
+    assert [p.name for p in tmp_path.iterdir()] == ["output.json.zst"]
+
 def test_compress_json(tmp_path):
     input_data = [{"id": 1, "name": "Test Player"}]
     input_file = tmp_path / "input.json"
-    output_file = tmp_path / "output.json.gz"
+    output_file = tmp_path / "output.json.zst"
     
     with open(input_file, "w") as f:
         json.dump(input_data, f)
@@ -114,8 +501,8 @@ def test_compress_json(tmp_path):
     compress_json(str(input_file), str(output_file))
     
     assert output_file.exists()
-    with gzip.open(output_file, "rb") as f:
-        compressed_data = json.loads(f.read().decode("utf-8"))
+    with open(output_file, "rb") as f:
+        compressed_data = json.loads(zstd.ZstdDecompressor().stream_reader(f).read().decode("utf-8"))
     assert compressed_data == input_data
 
 def test_decompress_json(tmp_path):
@@ -133,20 +520,58 @@ def test_decompress_json(tmp_path):
         decompressed_data = json.load(f)
     assert decompressed_data == input_data
 
+def test_decompress_json_gzip_spans_chunks(tmp_path):
+    input_data = [{"id": i, "name": f"Player {i}"} for i in range(5000)]
+    input_file = tmp_path / "input.json.gz"
+    output_file = tmp_path / "output.json"
+
+    with gzip.open(input_file, "wb") as f:
+        f.write(json.dumps(input_data).encode("utf-8"))
+
+    with patch("ea_fc25_scraper.index.COPY_CHUNK_SIZE", 1024):
+        decompress_json(str(input_file), str(output_file))
+
+    with open(output_file, "r") as f:
+        decompressed_data = json.load(f)
+    assert decompressed_data == input_data
+
+def test_decompress_json_zstd(tmp_path):
+    input_data = [{"id": 1, "name": "Test Player"}]
+    input_file = tmp_path / "input.json.zst"
+    output_file = tmp_path / "output.json"
+
+    with open(input_file, "wb") as f:
+        f.write(zstd.ZstdCompressor().compress(json.dumps(input_data).encode("utf-8")))
+
+    decompress_json(str(input_file), str(output_file))
+
+    with open(output_file, "r") as f:
+        decompressed_data = json.load(f)
+    assert decompressed_data == input_data
+
 @pytest.mark.asyncio
 async def test_main(tmp_path):
     mock_data = [{"id": 1, "name": "Test Player"}]
     
     with patch("ea_fc25_scraper.index.fetch_all_pages", return_value=mock_data), \
-         patch("ea_fc25_scraper.index.save_json") as mock_save, \
-         patch("ea_fc25_scraper.index.compress_json") as mock_compress, \
+         patch("ea_fc25_scraper.index.save_compressed") as mock_save, \
          patch("ea_fc25_scraper.index.OUTPUT_FILE", str(tmp_path / OUTPUT_FILE)), \
          patch("ea_fc25_scraper.index.COMPRESSED_OUTPUT_FILE", str(tmp_path / COMPRESSED_OUTPUT_FILE)):
         
         await main(skip_cache=True)
         
-        mock_save.assert_called_once_with(mock_data, str(tmp_path / OUTPUT_FILE))
-        mock_compress.assert_called_once_with(str(tmp_path / OUTPUT_FILE), str(tmp_path / COMPRESSED_OUTPUT_FILE))
+        mock_save.assert_called_once_with(
+            mock_data, str(tmp_path / COMPRESSED_OUTPUT_FILE), str(tmp_path / OUTPUT_FILE)
+        )
+
+@pytest.mark.asyncio
+async def test_main_parquet_without_pyarrow_fails_before_fetching():
+    with patch("ea_fc25_scraper.index.import_pyarrow", side_effect=ImportError("no pyarrow")), \
+         patch("ea_fc25_scraper.index.fetch_all_pages") as mock_fetch:
+        with pytest.raises(ImportError):
+            await main(skip_cache=True, parquet=True)
+
+    mock_fetch.assert_not_called()
 
 @pytest.mark.asyncio
 async def test_main_with_error(capsys):